@@ -1,21 +1,91 @@
 import os
 import time
 import random
-import json
-from flask import Flask, render_template, request, redirect, url_for, session
+import uuid
+import threading
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from flask import (
+    Flask, render_template, request, redirect, url_for, session, jsonify
+)
+from flask.json.provider import DefaultJSONProvider
+from flask_session import Session
+from flask_compress import Compress
+import redis
+from cachetools import LRUCache, TTLCache
+import jiter
+import orjson
+import httpx
 
 from google import genai
+from google.genai import errors, types
 
 # ======================================================
 # Flask setup
 # ======================================================
+class OrjsonProvider(DefaultJSONProvider):
+    # jsonify() and request.get_json() go through orjson
+    def dumps(self, obj, **kwargs):
+        # Same defaults as DefaultJSONProvider: its default() for Decimal,
+        # Markup and friends, and sorted keys unless turned off
+        option = 0
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(
+            obj, default=kwargs.get("default", self.default), option=option
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
 app.secret_key = "change-this-secret-key"
+app.json = OrjsonProvider(app)
+
+# Quiz state lives in Redis; the cookie only carries the session id
+app.config["SESSION_TYPE"] = "redis"
+app.config["SESSION_REDIS"] = redis.from_url(
+    os.environ.get("REDIS_URL", "redis://localhost:6379")
+)
+# Idle quizzes expire from Redis after an hour (Flask's default is 31
+# days); the quiz routes send an expired quiz back to the start page.
+# Only write the session back when a route changed it; every quiz step
+# does, which also renews the expiry, while / and the /status polls don't.
+app.config["PERMANENT_SESSION_LIFETIME"] = 3600
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+Session(app)
+
+# gzip/br for clients that accept it
+Compress(app)
 
 # ======================================================
 # Gemini client
 # ======================================================
-client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+# One module-level client, so every request shares its connection pool;
+# HTTP/2 lets the concurrent prefetches share a single TLS connection.
+# httpx drops idle connections after 5s by default, shorter than a user
+# takes to answer, so keep them for 5 minutes instead.
+client = genai.Client(
+    api_key=os.environ.get("GEMINI_API_KEY"),
+    http_options=types.HttpOptions(
+        # milliseconds; applies to each read, so a stalled stream fails too
+        timeout=60_000,
+        client_args={
+            "http2": True,
+            "limits": httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=50,
+                keepalive_expiry=300,
+            ),
+        },
+    ),
+)
+
+# Flash handles a four-option MCQ fine; Pro is only retried when Flash's
+# output doesn't parse into a question
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+GEMINI_FALLBACK_MODEL = os.environ.get("GEMINI_FALLBACK_MODEL", "gemini-2.5-pro")
 
 # ======================================================
 # Constants
@@ -29,29 +99,72 @@ QUESTION_CATEGORIES = [
 ]
 
 TOTAL_QUESTIONS = 10
+START_DIFFICULTY = 4
+
+# ======================================================
+# Question cache
+# ======================================================
+# Shared by all quizzes: (category, difficulty, round) -> [question, ...].
+# The round keeps questions 1 and 6 (same category) from colliding; each
+# key holds a few variants so quizzes on the same path don't all match.
+question_cache = LRUCache(maxsize=512)
+question_cache_lock = threading.Lock()
+topping_up = set()
+generating = {}  # key -> Future, while its first question is being made
+
+QUESTION_VARIANTS = 3
+
+# ======================================================
+# Background prefetch
+# ======================================================
+# Futures can't be serialized into the session, so they are kept here:
+# session["sid"] -> {(category, difficulty, qno): Future}
+# Tasks are almost all waiting on Gemini, and under the gevent worker each
+# one is a greenlet, so size the pool like worker_connections in
+# gunicorn.conf.py; a small pool made users' current questions queue
+# behind other quizzes' speculative prefetches
+executor = ThreadPoolExecutor(max_workers=1000)
+prefetched = TTLCache(maxsize=1024, ttl=3600)
+prefetch_lock = threading.Lock()
+
+# session["sid"] -> Future of the shown question's explanation,
+# which may still be streaming in
+explanations = TTLCache(maxsize=1024, ttl=3600)
+
+PREFETCH_TIMEOUT = 60
+PREFETCH_AT_START = 2  # questions generated concurrently on /start
+
+# Rate limits and server-side failures; anything else (bad request,
+# bad key) fails the same way on every attempt
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
 
 # ======================================================
 # Gemini call (robust)
 # ======================================================
-def call_gemini(prompt):
-    delay = 2
+def call_gemini(prompt, model):
+    # Returns an iterator over the streamed response text. The first
+    # chunk is read here, so failures before any output are retried.
+    delay = 1
     for attempt in range(4):
         try:
             if attempt > 0:
-                time.sleep(delay)
-                delay *= 2
+                # Full jitter, so concurrent users don't retry in lockstep
+                time.sleep(random.uniform(0, delay))
+                delay = min(16, delay * 2)
 
-            response = client.models.generate_content(
-                model="gemini-2.5-pro",
+            stream = client.models.generate_content_stream(
+                model=model,
                 contents=prompt,
-                config={"response_mime_type": "application/json"}
+                config=GENERATION_CONFIG
             )
 
-            if hasattr(response, "output_text") and response.output_text:
-                return response.output_text.strip()
+            chunks = (chunk.text or "" for chunk in stream)
+            return itertools.chain([next(chunks)], chunks)
 
-            if response.candidates and response.candidates[0].content.parts:
-                return response.candidates[0].content.parts[0].text.strip()
+        except errors.APIError as e:
+            print("Gemini error:", e)
+            if e.code not in RETRYABLE_STATUS:
+                break
 
         except Exception as e:
             print("Gemini error:", e)
@@ -91,13 +204,10 @@ def normalize_question(data):
 # ======================================================
 # Question generator
 # ======================================================
-def generate_question(category, difficulty, qno):
-    prompt = f"""
-You are generating ONE English proficiency multiple-choice question.
-
-Category: {category}
-Difficulty Level: {difficulty} (1 = beginner, 10 = expert)
-Question number: {qno}
+# Sent as the system instruction on every call, so the prompts below only
+# carry the per-question lines
+PROMPT_RULES = """
+You generate English proficiency multiple-choice questions.
 
 CATEGORY DEFINITIONS:
 - grammar
@@ -117,33 +227,250 @@ Use natural human contexts. Avoid academic tone.
 OUTPUT JSON ONLY.
 
 Schema A:
-{{
+{
   "question": "...",
   "correct_answer": "...",
   "distractors": ["...", "...", "..."],
   "explanation": "..."
-}}
+}
 
 Schema B:
-{{
+{
   "question": "...",
-  "options": {{
+  "options": {
       "A": "...",
       "B": "...",
       "C": "...",
       "D": "..."
-  }},
+  },
   "correct": "A/B/C/D",
   "explanation": "..."
-}}
+}
 """
 
-    raw = call_gemini(prompt)
-    if not raw:
+GENERATION_CONFIG = {
+    "system_instruction": PROMPT_RULES,
+    "response_mime_type": "application/json",
+}
+
+PROMPT_TEMPLATE = """
+You are generating ONE English proficiency multiple-choice question.
+
+Category: {category}
+Difficulty Level: {difficulty} (1 = beginner, 10 = expert)
+Question number: {qno}
+"""
+
+# Every prompt a quiz can ask for, built once at import
+QUESTION_PROMPTS = {
+    (category, difficulty, qno): PROMPT_TEMPLATE.format(
+        category=category, difficulty=difficulty, qno=qno
+    )
+    for category in QUESTION_CATEGORIES
+    for difficulty in range(1, 11)
+    for qno in range(1, TOTAL_QUESTIONS + 1)
+}
+
+BATCH_PROMPT_TEMPLATE = """
+You are generating {count} English proficiency multiple-choice questions,
+one for each line below (1 = beginner, 10 = expert):
+
+{items}
+
+Return a JSON array with one question per line above. Give each question
+an extra "item" field holding the number of the line it answers.
+"""
+
+
+def generate_question(category, difficulty, qno, model=GEMINI_MODEL):
+    chunks = call_gemini(QUESTION_PROMPTS[category, difficulty, qno], model)
+    if chunks is None:
         raise RuntimeError("Gemini unavailable")
 
-    data = json.loads(raw)
-    return normalize_question(data)
+    # "explanation" comes last and is only needed on the feedback page:
+    # once it starts, everything before it is complete, so return the
+    # question and let the explanation finish in the background.
+    # Only the schema keys repeat between responses, so cache just those.
+    raw = b""
+    for text in chunks:
+        raw += text.encode()
+        try:
+            data = jiter.from_json(
+                raw, partial_mode="trailing-strings", cache_mode="keys"
+            )
+            if list(data)[-1:] == ["explanation"]:
+                q = normalize_question(data)
+                q["explanation"] = finish_explanation(raw, chunks)
+                return q
+        except (ValueError, KeyError, TypeError):
+            continue
+
+    try:
+        return with_explanation_future(
+            normalize_question(jiter.from_json(raw, cache_mode="keys"))
+        )
+    except (ValueError, KeyError, TypeError) as e:
+        if model == GEMINI_FALLBACK_MODEL:
+            raise
+        print("Schema error:", e, "- retrying with", GEMINI_FALLBACK_MODEL)
+        return generate_question(
+            category, difficulty, qno, GEMINI_FALLBACK_MODEL
+        )
+
+
+def generate_questions(specs, model=GEMINI_MODEL):
+    # One Gemini call for several (category, difficulty, qno) specs; used
+    # where nobody is waiting, so the response isn't streamed. Returns
+    # {spec: question}, matched by "item" rather than array position
+    items = "\n".join(
+        f"{n}. Category: {category}, Difficulty Level: {difficulty}"
+        for n, (category, difficulty, _) in enumerate(specs, 1)
+    )
+    prompt = BATCH_PROMPT_TEMPLATE.format(count=len(specs), items=items)
+
+    chunks = call_gemini(prompt, model)
+    if chunks is None:
+        raise RuntimeError("Gemini unavailable")
+
+    try:
+        data = jiter.from_json("".join(chunks).encode(), cache_mode="keys")
+        if not isinstance(data, list):
+            raise ValueError("Expected a JSON array of questions")
+
+        # Skip bad items one at a time rather than re-asking for the batch
+        questions = {}
+        for d in data:
+            try:
+                item = d["item"]
+                if type(item) is int and 1 <= item <= len(specs):
+                    q = with_explanation_future(normalize_question(d))
+                    questions[specs[item - 1]] = q
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+
+        if not questions:
+            raise ValueError("No usable questions in batch")
+        return questions
+    except (ValueError, KeyError, TypeError) as e:
+        if model == GEMINI_FALLBACK_MODEL:
+            raise
+        print("Schema error:", e, "- retrying with", GEMINI_FALLBACK_MODEL)
+        return generate_questions(specs, GEMINI_FALLBACK_MODEL)
+
+
+def with_explanation_future(q):
+    explanation = Future()
+    explanation.set_result(q["explanation"])
+    q["explanation"] = explanation
+    return q
+
+
+def finish_explanation(raw, chunks):
+    # Read the rest of the stream on its own thread: on the shared executor
+    # it would queue behind other quizzes' prefetches while the question
+    # is already on screen
+    explanation = Future()
+
+    def read_tail(raw=raw):
+        try:
+            for text in chunks:
+                raw += text.encode()
+            data = jiter.from_json(raw, cache_mode="keys")
+            explanation.set_result(data.get("explanation", ""))
+        except Exception as e:
+            explanation.set_exception(e)
+
+    threading.Thread(target=read_tail, daemon=True).start()
+    return explanation
+
+
+def question_key(category, difficulty, qno):
+    return category, difficulty, (qno - 1) // len(QUESTION_CATEGORIES)
+
+
+def get_question(category, difficulty, qno):
+    key = question_key(category, difficulty, qno)
+    with question_cache_lock:
+        pool = question_cache.get(key, [])
+        q = random.choice(pool) if pool else None
+        top_up = 0 < len(pool) < QUESTION_VARIANTS and key not in topping_up
+        if top_up:
+            topping_up.add(key)
+        pending = generating.get(key)
+
+    if q is not None:
+        if top_up:
+            executor.submit(top_up_pool, key, category, difficulty, qno)
+        return q
+
+    if pending is not None:
+        try:
+            return pending.result(timeout=PREFETCH_TIMEOUT)
+        except TimeoutError:
+            # The other stream stalled; don't wait on it any longer
+            q = generate_question(category, difficulty, qno)
+            cache_question(key, q)
+            return q
+
+    claimed = claim_key(key)
+    if claimed is None:
+        # Someone else claimed or cached it since the check above
+        return get_question(category, difficulty, qno)
+
+    try:
+        q = generate_question(category, difficulty, qno)
+    except Exception as e:
+        settle_claim(key, claimed, error=e)
+        raise
+
+    settle_claim(key, claimed, q)
+    return q
+
+
+def claim_key(key):
+    # Single flight: the caller generates the key if it gets a Future back,
+    # and concurrent misses on it wait for that instead of calling Gemini
+    with question_cache_lock:
+        if key in question_cache or key in generating:
+            return None
+        claimed = generating[key] = Future()
+        return claimed
+
+
+def settle_claim(key, claimed, q=None, error=None):
+    if q is not None:
+        cache_question(key, q)
+
+    with question_cache_lock:
+        generating.pop(key, None)
+    if q is not None:
+        claimed.set_result(q)
+    else:
+        claimed.set_exception(error)
+
+
+def cache_question(key, q):
+    explanation = q["explanation"]
+    if not explanation.done():
+        # Streamed: pool it once the explanation has arrived, so a stream
+        # cut off mid-explanation doesn't leave a broken variant behind
+        explanation.add_done_callback(lambda _: cache_question(key, q))
+        return
+    if explanation.exception() is not None:
+        return
+
+    with question_cache_lock:
+        pool = question_cache.setdefault(key, [])
+        if len(pool) < QUESTION_VARIANTS:
+            pool.append(q)
+
+
+def top_up_pool(key, category, difficulty, qno):
+    try:
+        cache_question(key, generate_question(category, difficulty, qno))
+    finally:
+        with question_cache_lock:
+            topping_up.discard(key)
 
 
 # ======================================================
@@ -155,47 +482,171 @@ def shuffle_options(correct, distractors):
 
     labels = ["A", "B", "C", "D"]
     option_map = dict(zip(labels, options))
-    correct_label = next(k for k, v in option_map.items() if v == correct)
+    correct_label = labels[options.index(correct)]
 
     return option_map, correct_label
 
 
+# ======================================================
+# Prefetch helpers
+# ======================================================
+def next_slot(qno, difficulty):
+    category = session["categories"][qno % len(QUESTION_CATEGORIES)]
+    return category, difficulty, qno + 1
+
+
+def reachable_difficulties(difficulty, steps):
+    levels = {difficulty}
+    for _ in range(steps):
+        levels = {max(1, min(10, d + delta)) for d in levels for delta in (1, -1)}
+    return sorted(levels)
+
+
+def prefetch_question(sid, category, difficulty, qno):
+    slot = (category, difficulty, qno)
+    with prefetch_lock:
+        slots = prefetched.setdefault(sid, {})
+        if slot not in slots:
+            slots[slot] = executor.submit(get_question, *slot)
+        return slots[slot]
+
+
+def discard_branches(sid, category, difficulty, qno):
+    # Cancel prefetched questions up to qno that the quiz didn't take
+    slot = (category, difficulty, qno)
+    with prefetch_lock:
+        slots = prefetched.get(sid, {})
+        for stale in [s for s in slots if s[2] <= qno and s != slot]:
+            slots.pop(stale).cancel()
+
+
+def take_question(sid, category, difficulty, qno):
+    slot = (category, difficulty, qno)
+    discard_branches(sid, *slot)
+    with prefetch_lock:
+        future = prefetched.get(sid, {}).pop(slot, None)
+
+    if future:
+        try:
+            return future.result(timeout=PREFETCH_TIMEOUT)
+        except Exception as e:
+            print("Prefetch error:", e)
+
+    return get_question(category, difficulty, qno)
+
+
+def warm_batch(specs):
+    # Not claimed: a user missing one of these keys streams their own
+    # question rather than waiting on the whole non-streamed batch
+    with question_cache_lock:
+        specs = [
+            spec for spec in specs
+            if question_key(*spec) not in question_cache
+            and question_key(*spec) not in generating
+        ]
+    if not specs:
+        return
+
+    for spec, q in generate_questions(specs).items():
+        cache_question(question_key(*spec), q)
+
+
+def warm_question_cache():
+    # Every quiz opens with one of these, so generate them in the
+    # background as soon as the server starts: one call per difficulty,
+    # covering all categories. Called from gunicorn's post_worker_init
+    # and the __main__ block, not at import, so `import app` costs nothing
+    for step in range(PREFETCH_AT_START):
+        for difficulty in reachable_difficulties(START_DIFFICULTY, step):
+            executor.submit(warm_batch, [
+                (category, difficulty, step + 1)
+                for category in QUESTION_CATEGORIES
+            ])
+
+
+def wait_explanation(sid):
+    with prefetch_lock:
+        future = explanations.get(sid)
+
+    if future is None:
+        return ""
+
+    try:
+        return future.result(timeout=PREFETCH_TIMEOUT)
+    except Exception as e:
+        print("Explanation error:", e)
+        return ""
+
+
+
 # ======================================================
 # Routes
 # ======================================================
+# start.html has no per-request data, so render it once
+with app.app_context():
+    START_HTML = render_template("start.html")
+
+
 @app.route("/", methods=["GET", "POST"])
 def start():
     if request.method == "POST":
+        with prefetch_lock:
+            prefetched.pop(session.get("sid"), None)
         session.clear()
+        session["sid"] = uuid.uuid4().hex
         session["qno"] = 0
-        session["difficulty"] = 4
-        session["history"] = []
+        session["difficulty"] = START_DIFFICULTY
+        session["history"] = {"difficulties": [], "correct_mask": 0}
         session["categories"] = random.sample(
             QUESTION_CATEGORIES, len(QUESTION_CATEGORIES)
         )
+
+        # Fire the opening questions (every difficulty they can be
+        # reached at) together, so they cost one round-trip, not several
+        for step in range(PREFETCH_AT_START):
+            for difficulty in reachable_difficulties(START_DIFFICULTY, step):
+                prefetch_question(session["sid"], *next_slot(step, difficulty))
+
         return redirect(url_for("question"))
 
-    return render_template("start.html")
+    return START_HTML
 
 
 @app.route("/question")
 def question():
+    if "sid" not in session:
+        return redirect(url_for("start"))
+
     if session["qno"] >= TOTAL_QUESTIONS:
         return redirect(url_for("result"))
 
-    category = session["categories"][session["qno"] % len(QUESTION_CATEGORIES)]
-    difficulty = session["difficulty"]
+    category, difficulty, qno = next_slot(session["qno"], session["difficulty"])
 
-    q = generate_question(category, difficulty, session["qno"] + 1)
+    # Don't hold the request open for Gemini; loading.html polls /status
+    # and reloads this page once the question is ready
+    future = prefetch_question(session["sid"], category, difficulty, qno)
+    if not future.done():
+        return render_template("loading.html", qno=qno)
+
+    q = take_question(session["sid"], category, difficulty, qno)
 
     options, correct_label = shuffle_options(
         q["correct_answer"], q["distractors"]
     )
 
     session["current_correct"] = correct_label
-    session["current_explanation"] = q["explanation"]
+    with prefetch_lock:
+        explanations[session["sid"]] = q["explanation"]
     session["qno"] += 1
 
+    # Start both possible next questions (right/wrong answer) while the
+    # user is still answering this one
+    if session["qno"] < TOTAL_QUESTIONS:
+        for next_difficulty in reachable_difficulties(difficulty, 1):
+            prefetch_question(
+                session["sid"], *next_slot(session["qno"], next_difficulty)
+            )
+
     return render_template(
         "question.html",
         qno=session["qno"],
@@ -204,39 +655,69 @@ def question():
     )
 
 
+@app.route("/status")
+def status():
+    if "sid" not in session:
+        # Let loading.html reload into /question, which redirects
+        return jsonify(ready=True)
+
+    slot = next_slot(session["qno"], session["difficulty"])
+    with prefetch_lock:
+        future = prefetched.get(session["sid"], {}).get(slot)
+
+    return jsonify(ready=future is None or future.done())
+
+
 @app.route("/answer", methods=["POST"])
 def answer():
+    if "sid" not in session:
+        return redirect(url_for("start"))
+
+    # Popped so a double-submitted answer isn't scored twice
+    correct_label = session.pop("current_correct", None)
+    if correct_label is None:
+        return "No question to answer", 400
+
     user_ans = request.form.get("answer")
-    correct_label = session.get("current_correct")
 
     correct = user_ans == correct_label
-    session["history"].append((session["difficulty"], correct))
+    # Bit n is set when question n + 1 was answered correctly
+    session["history"]["difficulties"].append(session["difficulty"])
+    session["history"]["correct_mask"] |= correct << (session["qno"] - 1)
 
-    if correct:
-        session["difficulty"] = min(10, session["difficulty"] + 1)
-    else:
-        session["difficulty"] = max(1, session["difficulty"] - 1)
+    delta = 2 * correct - 1
+    session["difficulty"] = max(1, min(10, session["difficulty"] + delta))
+
+    # Keep the branch the answer picked, drop the other one
+    if session["qno"] < TOTAL_QUESTIONS:
+        slot = next_slot(session["qno"], session["difficulty"])
+        prefetch_question(session["sid"], *slot)
+        discard_branches(session["sid"], *slot)
 
     return render_template(
         "feedback.html",
         correct=correct,
         correct_label=correct_label,
-        explanation=session.get("current_explanation", "")
+        explanation=wait_explanation(session["sid"])
     )
 
 
 @app.route("/result")
 def result():
-    history = session.get("history", [])
+    if "sid" not in session:
+        return redirect(url_for("start"))
+
+    history = session["history"]
+    difficulties = history["difficulties"]
 
-    correct = sum(1 for _, c in history if c)
-    avg_level = round(sum(d for d, _ in history) / len(history), 1)
+    correct = bin(history["correct_mask"]).count("1")
+    avg_level = round(sum(difficulties) / len(difficulties), 1)
     score = min(100, int(avg_level * 8 + correct * 2))
 
     return render_template(
         "result.html",
         avg_level=avg_level,
-        accuracy=round(100 * correct / len(history), 1),
+        accuracy=round(100 * correct / len(difficulties), 1),
         score=score
     )
 
@@ -247,5 +728,6 @@ def result():
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 10000))
+    warm_question_cache()
     app.run(host="0.0.0.0", port=port)
 
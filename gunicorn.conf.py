@@ -0,0 +1,18 @@
+# Picked up automatically by `gunicorn app:app` from this directory
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+
+# Gemini calls are pure network wait, so one gevent worker can hold many
+# of them; keep a single process since the prefetch futures and the
+# question cache live in memory
+worker_class = "gevent"
+workers = 1
+worker_connections = 1000
+timeout = 60
+
+
+def post_worker_init(worker):
+    # The app is loaded by now; warm its question cache in this worker
+    from app import warm_question_cache
+    warm_question_cache()